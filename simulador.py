@@ -1,15 +1,79 @@
 import argparse
-import json
-import pickle
+import logging
 import random
-import os
-import csv
-from statistics import stdev, median
+import math
+from dataclasses import dataclass
+import numpy as np
+from numba import njit, prange
 
 ## Global Variables
 # Write data to a CSV file
 FILENAME_RESULTS = "simulation.csv"
-FILENAME_RAW = "data.txt"
+FILENAME_RAW = "data.bin"
+# Size of the write buffer of the files and number of result rows buffered before writing them
+FILE_BUFFERING = 1 << 20
+RESULTS_BUFFER_ROWS = 1024
+# Maximum number of components simulated at once, the runs of a chunk use about 100 bytes per component
+COMPONENTS_PER_CHUNK = 1 << 18
+
+RESULTS_HEADER = [
+    # "Component Type", "ASIL Level", "CAL Level", "Data/Privacy",
+    # "Isolated Entity", "Interation Risk", "W", "M", "L", "Component Rating",
+    "sum_D",
+    "n_Times_D",
+    "Avg_D",
+    "mean_D",
+    "std_D",
+    "sum_C",
+    "n_Times_C",
+    "Avg_C",
+    "mean_C",
+    "std_C",
+    "sum_B",
+    "n_Times_B",
+    "Avg_B",
+    "mean_B",
+    "std_B",
+    "sum_A",
+    "n_Times_A",
+    "Avg_A",
+    "mean_A",
+    "std_A",
+    "Final Rating",
+    "Seed Value",
+    "Run Nr",
+    "Total nr of Runs",
+]
+"""Header of the CSV file with the results of each run, the mean_ columns have the median of the category"""
+
+RESULTS_LINE_END = "\r\n"
+RESULTS_ROW_FORMAT = "%.2f,%d,%.2f,%.2f,%.2f," * 4 + "%.2f,%d,%d,%d" + RESULTS_LINE_END
+"""printf-style format of a row of the CSV file, all the values are numbers so no csv quoting is needed"""
+
+# The vulnerability values have one decimal between 0 and 6.9, so there are 70 different values
+RATING_TABLE_SIZE = 70
+
+RUN_DT = np.dtype([("seedValue", "i8"), ("runNr", "i8"), ("totalRuns", "i8"), ("numberECUs", "i8")])
+"""Header of each run in the raw data file, followed by numberECUs records"""
+
+RECORD_DT = np.dtype(
+    [
+        ("comp", "u1"),  # index in COMPONENT_TYPES
+        ("asil", "u1"),  # index in SAFETY_LEVELS
+        ("cal", "u1"),  # CAL level (1 to 4)
+        ("dp", "u1"),  # Data Or Privacy, index in YES_NO
+        ("iso", "u1"),  # Isolated Entity, index in YES_NO
+        ("risk", "u1"),  # interaction risk, index in RISK_LEVELS
+        ("W", "f4"),
+        ("M", "f4"),
+        ("L", "f4"),
+        ("rating", "f4"),  # Component rating
+    ]
+)
+"""Record of a component in the raw data file"""
+
+logger = logging.getLogger(__name__)
+"""Logger of the simulation, the progress messages are only shown with --verbose"""
 
 COMPONENT_TYPES = ["ADAS", "Powertrain", "HMI", "Body", "Chassis"]
 """The Type of components that can be used in the simulation"""
@@ -131,95 +195,112 @@ INTERACTION_RISK_MAP = {
     ],  # Chassis tends to have moderate or low risks
 }
 
-def generate_simulation_data(
-    numberECUs,
-    vulnProb,
-    categoriesValues,
-    maxVuln,
-    minVuln,
-    adasWeight,
-    powertWeight,
-    hmiWeight,
-    bodyWeight,
-    chWeight,
-    qmWeight,
-    aWeight,
-    bWeight,
-    cWeight,
-    dWeight,
-):
-    """Generates a list of rows with random data matching the simulation."""
-
-    finalData = []
-    vulnsWML = []
+RISK_LEVELS = ["None", "Low", "Moderate", "High"]
+"""The interaction risks in ascending order, the index is used as the code of the risk"""
 
-    component_probs = [adasWeight, powertWeight, hmiWeight, bodyWeight, chWeight]
-    # Choose numberECUs components randomly with the given probabilities and replacement
-    list_selected_components = random.choices(COMPONENT_TYPES, weights=component_probs, k=numberECUs)
-    safety_probs = [qmWeight, aWeight, bWeight, cWeight, dWeight]
+YES_NO = ["Yes", "No"]
+"""The answers for Data Or Privacy and Isolated Entity, the index is used as the code of the answer"""
 
-    for selected_component in list_selected_components:
-        # Define the safety levels that depend on the CAL levels
-        selected_asil = random.choices(SAFETY_LEVELS, weights=safety_probs, k=1)[0]
+CAL_LENS = np.array([len(CAL_MAPPING[asil]) for asil in SAFETY_LEVELS], dtype=np.int8)
+"""Number of CAL levels of each safety level in CAL_MAPPING"""
+CAL_TABLE = np.array(
+    [CAL_MAPPING[asil] + [0] * (CAL_LENS.max() - len(CAL_MAPPING[asil])) for asil in SAFETY_LEVELS], dtype=np.int8
+)
+"""CAL_MAPPING as a table indexed by [ASIL, choice], the rows are padded with 0 after CAL_LENS levels"""
 
-        # within the existing CAL choose a level randomly with equal probability
-        selected_cal = random.choice(CAL_MAPPING[selected_asil])
+RISK_TABLE = np.array(
+    [[RISK_LEVELS.index(risk) for risk in INTERACTION_RISK_MAP[component]] for component in COMPONENT_TYPES], dtype=np.int8
+)
+"""INTERACTION_RISK_MAP as a table of risk codes indexed by [component, choice]"""
 
-        # Randomly choose the interaction risk from the INTERACTION_RISK_MAP for the selected component
-        interaction_risk = random.choice(INTERACTION_RISK_MAP[selected_component])
-
-        # Probability of generating (0,0,0)
-        if random.random() > vulnProb:
-            vulnsWML = [0, 0, 0]
-        # Probability of generating vulns
-        else:
-            # Decide how many vulnerabilities to generate (1, 2, or 3)
-            num_vulns = random.randint(1, 3)
-            # Random W, M, (0 to 6.9)
-            vulnsWML = [round(random.uniform(minVuln, maxVuln), 1) for _ in range(num_vulns)]
-            # In case we do not have vulns just fill 0
-            while len(vulnsWML) < 3:
-                vulnsWML.append(0)
-        
-            # Check if any value in the list is >= 5.3
-            if max(vulnsWML) >= 5.3:
-                vulnsWML = [max(vulnsWML), 0, 0]
-            else:
-                vulnsWML.sort(reverse=True)
-        
-        data = [
-            # Random Types of components
-            selected_component,
-            # Random ASIL Level
-            selected_asil,
-            # Random CAL Level (1 to 4)
-            selected_cal,
-            # Random Data Or Privacy (Yes/No)
-            random.choice(["Yes", "No"]),
-            # Random Isolated Entity (Yes/No)
-            random.choice(["Yes", "No"]),
-            interaction_risk,
-            vulnsWML[0],
-            vulnsWML[1],
-            vulnsWML[2],
-        ]
-        # Component rating based (-0.725 * result) + 5 with one decimal
-        data.append(round(componentRatingCalculus(vulnsWML[0], vulnsWML[1], vulnsWML[2]), 1))
-        # Vehicle Rating
-        # 1 = ASIL Level,
-        # 2 = CAL Level,
-        # 3 = Data Or Privacy,
-        # 4 = Isolated Entity,
-        # 5     = interaction risk associated to each component
-        # 9 = Component rating
-        # data.append(vehicleRatingCalculus(values, categoriesValues, data[1], data[2], data[3], data[4], data[5], data[9]))
-        categoriesValues = addComponentToCategory(categoriesValues, data[1], data[2], data[3], data[4], data[5], data[9])
-        finalData.append(data)
-    # after doing all the components calculate car rating
-    finalRating = vehicleRatingWeightCalculus(categoriesValues)
-
-    return (finalData, categoriesValues, finalRating)
+CATEGORY_WEIGHTS = np.array([0.5, 0.3, 0.15, 0.05])
+"""Weight of each category (Class D, C, B and A) in the vehicle 5-grade rating part B"""
 
+def generate_simulation_data(
+    nr_runs,
+    numberECUs,
+    vulnProbs,
+    maxVuln,
+    minVuln,
+    component_cdf,
+    safety_cdf,
+    rng,
+):
+    """Generates nr_runs runs of numberECUs components with random data matching the simulation.
+
+    Returns the runs (a RUN_DT header and the RECORD_DT records of each run), the ratings of each run
+    grouped by class and the sum, squared deviations and number of the ratings of each class."""
+
+    shape = (nr_runs, numberECUs)
+
+    # Choose numberECUs components and safety levels randomly with the given probabilities and replacement
+    # (the same draws as rng.choice with the probabilities, without rebuilding their cumulative sum)
+    comps = component_cdf.searchsorted(rng.random(shape), side="right")
+    asils = safety_cdf.searchsorted(rng.random(shape), side="right").astype(np.int8)
+
+    # within the existing CAL choose a level randomly with equal probability
+    cals = CAL_TABLE[asils, rng.integers(0, CAL_LENS[asils])]
+
+    # Randomly choose the interaction risk from the INTERACTION_RISK_MAP for the selected component
+    risks = RISK_TABLE[comps, rng.integers(0, RISK_TABLE.shape[1], size=shape)]
+
+    # Random Data Or Privacy (Yes/No) and Isolated Entity (Yes/No), packed as the two bits of a single draw
+    flags = rng.integers(0, 4, size=shape, dtype=np.uint8)
+    dps = flags & 1
+    isos = flags >> 1
+
+    # Probability of generating vulns (vulnProbs has one per run), otherwise (0,0,0)
+    has_vuln = rng.random(shape) <= np.asarray(vulnProbs)[:, None]
+    # Decide how many vulnerabilities to generate (1, 2, or 3), none for the components without vulns
+    num_vulns = rng.integers(1, 4, size=shape)
+    num_vulns[~has_vuln] = 0
+    # Random W, M, L (0 to 6.9) with one decimal, kept as integer tenths (0 to 69)
+    # (the values after num_vulns are cleared, sorted and collapsed by simulate_runs)
+    vulnsWML = np.rint(rng.uniform(minVuln * 10, maxVuln * 10, size=shape + (3,))).astype(np.int16)
+
+    # the records are filled in place in the array that write_to_file_raw writes to the raw data file,
+    # the headers are filled there
+    runs = np.empty(nr_runs, dtype=[("header", RUN_DT), ("records", RECORD_DT, (numberECUs,))])
+    records = runs["records"]
+
+    ratings = np.empty(shape)
+    class_idx = np.empty(shape, dtype=np.int8)
+    classRatings = np.empty(shape)
+    sums = np.zeros((nr_runs, 4))
+    squaredDeviations = np.zeros((nr_runs, 4))
+    counts = np.zeros((nr_runs, 4), dtype=np.int64)
+    simulate_runs(
+        vulnsWML,
+        num_vulns,
+        asils,
+        cals,
+        dps,
+        isos,
+        risks,
+        RATING_TABLE,
+        ROUNDED_RATING_TABLE,
+        ratings,
+        records["rating"],
+        class_idx,
+        classRatings,
+        sums,
+        squaredDeviations,
+        counts,
+    )
+
+    records["comp"] = comps
+    records["asil"] = asils
+    records["cal"] = cals
+    records["dp"] = dps
+    records["iso"] = isos
+    records["risk"] = risks
+    records["W"] = vulnsWML[..., 0] / 10
+    records["M"] = vulnsWML[..., 1] / 10
+    records["L"] = vulnsWML[..., 2] / 10
+
+    return (runs, classRatings, sums, squaredDeviations, counts)
+
+@njit("f8(f8)", cache=True)
 def checkVulnRange(val: float) -> float:
     """Validate and adjust input values to be within [0.1, 6.9]"""
 
@@ -230,6 +311,7 @@ def checkVulnRange(val: float) -> float:
     else:
         return val
 
+@njit("f8(f8,f8,f8)", cache=True)
 def componentRatingCalculus(valW: float, valM: float, valL: float) -> float:
     """Calculates the component 5-grade rating based on the input values."""
 
@@ -238,21 +320,20 @@ def componentRatingCalculus(valW: float, valM: float, valL: float) -> float:
     valM = checkVulnRange(valM)
     valL = checkVulnRange(valL)
 
-    # Count valid inputs
-    valid_values = [val for val in [valW, valM, valL] if val > 0]
-    count_available = len(valid_values)
+    # Count valid inputs, after the range check all the missing values are 0
+    count_available = (valW > 0) + (valM > 0) + (valL > 0)
 
     # Compute the weighted result based on the number of valid inputs
     if count_available == 3:  # All three values are available
         result = (valW * 0.6) + (valM * 0.3) + (valL * 0.1)
     elif count_available == 2:  # Only two values are available
-        # Sort valid values in descending order
-        valid_values.sort(reverse=True)
-        # Use the two highest values with weights 0.6 and 0.4
-        result = (valid_values[0] * 0.6) + (valid_values[1] * 0.4)
+        # Use the two highest values with weights 0.6 and 0.4, the missing value is the lowest
+        highest = max(valW, valM, valL)
+        second = max(min(valW, valM), min(max(valW, valM), valL))
+        result = (highest * 0.6) + (second * 0.4)
     elif count_available == 1:  # Only one value is available
         # Use the single available value
-        result = valid_values[0]
+        result = max(valW, valM, valL)
     else:  # No values are available
         result = 0
 
@@ -261,61 +342,199 @@ def componentRatingCalculus(valW: float, valM: float, valL: float) -> float:
 
     return componentRatingfinal_grade
 
-def addComponentToCategory(categoriesValues, asil, cal, dp, iso, risk, cRating):
-    """Adds the current component to the correct category"""
+def classifyComponents(asils, cals, dps, isos, risks):
+    """Returns the category of each component: 0 = Class D, 1 = Class C, 2 = Class B, 3 = Class A"""
 
-    # Check if component rating is between 0 and 5
-    if cRating >= 0 and cRating <= 5:
-        # Class D
-        if (asil == "D" or asil == "C") or (asil == "B" or asil == "A") and (cal == 4 or cal == 3):
-            categoriesValues[0].append(cRating)
+    # ASIL levels, answers and risks are the indexes in SAFETY_LEVELS, YES_NO and RISK_LEVELS
+    asilCD = asils >= SAFETY_LEVELS.index("C")
+    asilAB = (asils == SAFETY_LEVELS.index("A")) | (asils == SAFETY_LEVELS.index("B"))
+    dpYes = dps == YES_NO.index("Yes")
+    isoYes = isos == YES_NO.index("Yes")
 
+    conditions = [
+        # Class D
+        asilCD | asilAB & ((cals == 4) | (cals == 3)),
         # Class C
-        elif ((asil == "B" or asil == "A") and cal == 2 and dp == "Yes") or risk in ["High","Moderate"]:
-            categoriesValues[1].append(cRating)
-
+        (asilAB & (cals == 2) & dpYes) | (risks >= RISK_LEVELS.index("Moderate")),
         # Class B
-        elif ((asil == "B" or asil == "A") and cal == 2 and dp == "No" and iso == "No") or risk in ["Moderate","Low"]:
-            categoriesValues[2].append(cRating)
+        (asilAB & (cals == 2) & ~dpYes & ~isoYes) | (risks == RISK_LEVELS.index("Moderate")) | (risks == RISK_LEVELS.index("Low")),
+    ]
+    # Class A (other types)
+    return np.select(conditions, [0, 1, 2], default=3).astype(np.int8)
+
+def buildClassTable():
+    """Evaluates classifyComponents for every (ASIL, CAL, Data Or Privacy, Isolated Entity, interaction risk) combination"""
+
+    asils, cals, dps, isos, risks = np.indices((len(SAFETY_LEVELS), 4, len(YES_NO), len(YES_NO), len(RISK_LEVELS)))
+    return classifyComponents(asils, cals + 1, dps, isos, risks)
+
+CLASS_TABLE = buildClassTable()
+"""Category of each component indexed by [ASIL, CAL - 1, Data Or Privacy, Isolated Entity, interaction risk]"""
+
+@njit("i8(i8)", cache=True)
+def vulnIndex(val: int) -> int:
+    """Returns the index in RATING_TABLE of a vulnerability value in tenths, as checkVulnRange does"""
+
+    return min(max(val, 0), RATING_TABLE_SIZE - 1)
+
+@njit("f8[:,:,::1]()", cache=True)
+def buildRatingTable():
+    """Evaluates componentRatingCalculus for every (W, M, L) combination of values with one decimal"""
+
+    ratingTable = np.empty((RATING_TABLE_SIZE, RATING_TABLE_SIZE, RATING_TABLE_SIZE))
+    for w in range(RATING_TABLE_SIZE):
+        for m in range(RATING_TABLE_SIZE):
+            for l in range(RATING_TABLE_SIZE):
+                ratingTable[w, m, l] = componentRatingCalculus(w / 10, m / 10, l / 10)
+    return ratingTable
+
+RATING_TABLE = buildRatingTable()
+"""Component rating indexed by [W, M, L] with the vulnerability values in tenths converted by vulnIndex"""
+
+def buildRoundedRatingTable():
+    """Rounds RATING_TABLE to one decimal with the Python round, which rounds the exact binary value"""
+
+    # np.round scales by 10 and rounds half to even, so only the few distinct ratings are rounded in Python
+    values, positions = np.unique(RATING_TABLE, return_inverse=True)
+    return np.array([round(value, 1) for value in values.tolist()])[positions].reshape(RATING_TABLE.shape)
+
+ROUNDED_RATING_TABLE = buildRoundedRatingTable()
+"""RATING_TABLE with the ratings rounded to one decimal, as written to the raw data file"""
+
+@njit(
+    "void(i2[:,:,:],i8[:,:],i1[:,:],i1[:,:],u1[:,:],u1[:,:],i1[:,:],f8[:,:,:],f8[:,:,:],f8[:,:],f4[:,:],i1[:,:],f8[:,:],"
+    "f8[:,:],f8[:,:],i8[:,:])",
+    parallel=True,
+    cache=True,
+)
+def simulate_runs(
+    vulnsWML,
+    num_vulns,
+    asils,
+    cals,
+    dps,
+    isos,
+    risks,
+    ratingTable,
+    roundedRatingTable,
+    ratings,
+    recordRatings,
+    class_idx,
+    classRatings,
+    sums,
+    squaredDeviations,
+    counts,
+):
+    """Rates and classifies the components of every run, filling their ratings and classes and the ratings,
+    sum, squared deviations and number of the ratings of each class of every run."""
 
-        # Class A (other types)
+    for nRun in prange(ratings.shape[0]):
+        for i in range(ratings.shape[1]):
+            # In case we do not have vulns just fill 0
+            valW = vulnsWML[nRun, i, 0] if num_vulns[nRun, i] > 0 else 0
+            valM = vulnsWML[nRun, i, 1] if num_vulns[nRun, i] > 1 else 0
+            valL = vulnsWML[nRun, i, 2] if num_vulns[nRun, i] > 2 else 0
+
+            # Sort in descending order with the min/max of the three values, and in case any value
+            # is >= 5.3 keep only the maximum
+            highest = max(valW, valM, valL)
+            second = max(min(valW, valM), min(max(valW, valM), valL))
+            lowest = min(valW, valM, valL)
+            if highest >= 53:
+                second = 0
+                lowest = 0
+            vulnsWML[nRun, i, 0] = highest
+            vulnsWML[nRun, i, 1] = second
+            vulnsWML[nRun, i, 2] = lowest
+
+            # Component rating based (-0.725 * result) + 5, ratingTable is RATING_TABLE passed as an argument
+            # so numba does not compile it as a constant
+            cRating = ratingTable[vulnIndex(highest), vulnIndex(second), vulnIndex(lowest)]
+            ratings[nRun, i] = cRating
+            # Component rating with one decimal for the records
+            recordRatings[nRun, i] = roundedRatingTable[vulnIndex(highest), vulnIndex(second), vulnIndex(lowest)]
+
+            # Only components with a rating between 0 and 5 (with one decimal) are added to a category
+            if cRating > -0.05 and cRating < 5.05:
+                category = CLASS_TABLE[asils[nRun, i], cals[nRun, i] - 1, dps[nRun, i], isos[nRun, i], risks[nRun, i]]
+                class_idx[nRun, i] = category
+                sums[nRun, category] += cRating
+                counts[nRun, category] += 1
+            else:
+                class_idx[nRun, i] = -1
+
+        # position in classRatings of the next rating of each class, the ratings are grouped by class
+        # starting with Class D
+        positions = np.empty(4, dtype=np.int64)
+        positions[0] = 0
+        for category in range(1, 4):
+            positions[category] = positions[category - 1] + counts[nRun, category - 1]
+        for i in range(ratings.shape[1]):
+            category = class_idx[nRun, i]
+            if category >= 0:
+                classRatings[nRun, positions[category]] = ratings[nRun, i]
+                positions[category] += 1
+                # two-pass variance, the average of the class is known after the first pass
+                deviation = ratings[nRun, i] - sums[nRun, category] / counts[nRun, category]
+                squaredDeviations[nRun, category] += deviation * deviation
+
+@njit("void(f8[:,:],f8[:,:],i8[:,:],f8[:,:],f8[:,:],f8[:,:],f8[:,:],f8[:])", parallel=True, cache=True)
+def summarize_runs(sums, squaredDeviations, counts, classRatings, avgs, medians, stds, finalRatings):
+    """Calculates the average, median and standard deviation of each category and the vehicle 5-grade rating
+    part B of every run."""
+
+    for nRun in prange(counts.shape[0]):
+        total_weight = 0.0
+        weightedRating = 0.0
+        start = 0
+        for category in range(4):
+            num = counts[nRun, category]
+            avgs[nRun, category] = 0.0
+            medians[nRun, category] = 0.0
+            stds[nRun, category] = 0.0
+            # Only the categories with detected values count for the final rating
+            if num > 0:
+                avg = sums[nRun, category] / num
+                avgs[nRun, category] = avg
+                # the averages of the categories are weighted by CATEGORY_WEIGHTS
+                total_weight += CATEGORY_WEIGHTS[category]
+                weightedRating += CATEGORY_WEIGHTS[category] * avg
+                if num > 1:
+                    # sample standard deviation
+                    stds[nRun, category] = math.sqrt(squaredDeviations[nRun, category] / (num - 1))
+                # classRatings holds the ratings of each run grouped by category, as filled by simulate_runs
+                medians[nRun, category] = np.median(classRatings[nRun, start : start + num])
+                start += num
+
+        # Normalize the weights of the categories with detected values
+        finalRatings[nRun] = weightedRating / total_weight if total_weight > 0 else 0.0
+
+def flattenSecurityFeatures():
+    """Flattens SECURITY_FEATURES into lists of the feature names, their weights, the index of their
+    mutually exclusive group (-1 for standalone features) and their position in the group, plus
+    the size of each group"""
+
+    names, weights, groups, positions, group_sizes = [], [], [], [], []
+    for feature, value in SECURITY_FEATURES.items():
+        if isinstance(value, dict):  # mutual exclusion situation with sub-features
+            for position, (sub_feature, sub_value) in enumerate(value.items()):
+                names.append(sub_feature)
+                weights.append(sub_value)
+                groups.append(len(group_sizes))
+                positions.append(position)
+            group_sizes.append(len(value))
         else:
-            categoriesValues[3].append(cRating)
-
-    return categoriesValues
-
-def vehicleRatingWeightCalculus(categoriesValues):
-    """Calculates the vehicle 5-grade rating part B"""
-
-    weights = [0.5, 0.3, 0.15, 0.05]
-    finalScore = 0
-    adjusted_weights = []
-    total_weight = 0
-    values = [[0, 0], [0, 0], [0, 0], [0, 0]]
-    for category in range(len(categoriesValues)):
-        values[category][0] = sum(categoriesValues[category])
-        values[category][1] = len(categoriesValues[category])
-
-    # Adjust weights and calculate the total weight for non-missing values
-    for i in range(len(values)):
-        # Check if the counter of detected values is greater than 0
-        if values[i][1] > 0:
-            adjusted_weights.append(weights[i])
-            total_weight += weights[i]
-
-    for i in range(len(values)):
-        if values[i][1] > 0:
-            # Normalize the weights
-            averageRating = values[i][0] / values[i][1]
-            normalized_weight = weights[i] / total_weight
-            finalScore += normalized_weight * averageRating
-
-    print(values)
-    print(round(finalScore, 2))
-
-    return finalScore
-
-def vulbproba_security_feature(type):
+            names.append(feature)
+            weights.append(value)
+            groups.append(-1)
+            positions.append(0)
+
+    return names, np.array(weights), np.array(groups), np.array(positions), np.array(group_sizes)
+
+FEATURE_NAMES, FEATURE_WEIGHTS, FEATURE_GROUPS, FEATURE_GROUP_POSITIONS, FEATURE_GROUP_SIZES = flattenSecurityFeatures()
+"""SECURITY_FEATURES flattened into arrays, so the auto simulation draws all the features at once"""
+
+def vulbproba_security_feature(type, rng):
     base_vulnProb = 1.0 # ECU unsecure and without security features
     min_vulnProb = 0.05 # ECU secure but it is impossible to have a 100% secure system
     enabled_features = [] # Features available implemented on the ECU
@@ -336,134 +555,196 @@ def vulbproba_security_feature(type):
                     base_vulnProb -=value
             
     elif type == "auto":
-        for feature, value in SECURITY_FEATURES.items():
-            if isinstance(value, dict): #mutual exclusion situation with sub-feature detected
-                sub_features = list(value.items()) 
-                chosen_feature = random.choice([None] + sub_features)
-                if chosen_feature:
-                    sub_feature, sub_value = chosen_feature
-                    enabled_features.append(sub_feature)
-                    base_vulnProb -=sub_value 
-            else: 
-                if random.choice([True, False]):
-                    enabled_features.append(feature)
-                    base_vulnProb -=value
+        # each mutual exclusion group enables none (0) or one of its sub-features with equal probability
+        chosen = rng.integers(0, FEATURE_GROUP_SIZES + 1)
+        # standalone features are enabled with probability 0.5
+        picks = np.where(
+            FEATURE_GROUPS < 0,
+            rng.random(len(FEATURE_WEIGHTS)) < 0.5,
+            chosen[FEATURE_GROUPS] == FEATURE_GROUP_POSITIONS + 1,
+        )
+        enabled_features = [FEATURE_NAMES[i] for i in np.flatnonzero(picks)]
+        base_vulnProb -= FEATURE_WEIGHTS[picks].sum()
        
     base_vulnProb = max(base_vulnProb, min_vulnProb)
-    base_vulnProb = round(base_vulnProb, 2)
+    base_vulnProb = round(float(base_vulnProb), 2)
 
-    print("Enabled features:", enabled_features)
-    print("Vulnerability probability:", base_vulnProb)
+    logger.debug("Enabled features: %s", enabled_features)
+    logger.debug("Vulnerability probability: %s", base_vulnProb)
 
     return base_vulnProb
 
-def write_to_file_raw(data, seedValue, runNr, totalRuns, format="pickle"):
-    """Write the raw data to a file, including seedValue, run number and total number of runs to do"""
-
-    # each object has all the information
-    objToWrite = [[seedValue, runNr, totalRuns], data]
-
-    if format == "pickle":
-        with open(FILENAME_RAW, "ab") as file_raw:
-            pickle.dump(objToWrite, file_raw)
-
-    elif format == "json":
-        with open(FILENAME_RAW, mode="a", newline="", encoding="utf-8") as file_raw:
-            # each line is a valid json object. The file itself will not be
-            jsonObjStr = json.dumps(objToWrite, separators=(",", ":"))
-            print(jsonObjStr, file=file_raw)
-
-    else:  # any other format is bare
-        with open(FILENAME_RAW, mode="a", newline="", encoding="utf-8") as file_raw:
-            print(objToWrite, file=file_raw)
-
-def write_to_file(data, categoriesValues, finalRating=0.0, seedValue=0, runNr=0, totalRuns=0):
-    """Write the generated simulation data to a CSV file."""
-
-    # write the raw data to a file
-    write_to_file_raw(data, seedValue, runNr, totalRuns)
-
-    file_exists = os.path.exists(FILENAME_RESULTS)
-
-    with open(FILENAME_RESULTS, mode="a", newline="", encoding="utf-8") as file:
-        writer = csv.writer(file, delimiter=",")
-
-        if not file_exists:
-            # Define header for the CSV file
-            writer.writerow(
+def write_to_file_raw(file_raw, runs, seedValue, firstRunNr, totalRuns):
+    """Write the runs of a chunk from generate_simulation_data to the open binary file in a single call,
+    filling the RUN_DT header of each run with seedValue, run number (from firstRunNr), total number of
+    runs to do and number of records"""
+
+    runs["header"]["seedValue"] = seedValue
+    runs["header"]["runNr"] = np.arange(firstRunNr, firstRunNr + runs.size)
+    runs["header"]["totalRuns"] = totalRuns
+    runs["header"]["numberECUs"] = runs.dtype["records"].shape[0]
+    # the buffer of the array is written without copying it
+    file_raw.write(memoryview(runs))
+
+def read_file_raw(filename=FILENAME_RAW):
+    """Read the raw data file, yielding for each run [[seedValue, runNr, totalRuns], rows] with one row
+    of labels and values per component, as in the simulation"""
+
+    with open(filename, "rb") as file_raw:
+        while headerBytes := file_raw.read(RUN_DT.itemsize):
+            header = np.frombuffer(headerBytes, dtype=RUN_DT)[0]
+            records = np.frombuffer(file_raw.read(int(header["numberECUs"]) * RECORD_DT.itemsize), dtype=RECORD_DT)
+            rows = [
                 [
-                    # "Component Type", "ASIL Level", "CAL Level", "Data/Privacy",
-                    # "Isolated Entity", "Interation Risk", "W", "M", "L", "Component Rating",
-                    "sum_D",
-                    "n_Times_D",
-                    "Avg_D",
-                    "mean_D",
-                    "std_D",
-                    "sum_C",
-                    "n_Times_C",
-                    "Avg_C",
-                    "mean_C",
-                    "std_C",
-                    "sum_B",
-                    "n_Times_B",
-                    "Avg_B",
-                    "mean_B",
-                    "std_B",
-                    "sum_A",
-                    "n_Times_A",
-                    "Avg_A",
-                    "mean_A",
-                    "std_A",
-                    "Final Rating",
-                    "Seed Value",
-                    "Run Nr",
-                    "Total nr of Runs",
+                    COMPONENT_TYPES[comp],
+                    SAFETY_LEVELS[asil],
+                    cal,
+                    YES_NO[dp],
+                    YES_NO[iso],
+                    RISK_LEVELS[risk],
+                    round(valW, 1),
+                    round(valM, 1),
+                    round(valL, 1),
+                    round(cRating, 1),
                 ]
-            )  # Write the header row
-
-        num = [0, 0, 0, 0]
-        avg = [0.0, 0.0, 0.0, 0.0]
-        std = [0.0, 0.0, 0.0, 0.0]
-        med = [0.0, 0.0, 0.0, 0.0]
-        summ = [0.0, 0.0, 0.0, 0.0]
-        for i in range(len(num)):
-            num[i] = len(categoriesValues[i])
-            if num[i] > 0:
-                summ[i] = sum(categoriesValues[i])
-                avg[i] = summ[i] / num[i]
-                std[i] = stdev(categoriesValues[i]) if num[i] > 1 else 0
-                med[i] = median(categoriesValues[i])
-
-        writer.writerow(
-            [
-                summ[0],  # sum D
-                num[0],  # n Times D
-                avg[0],  # Avg D
-                med[0],  # mean D
-                std[0],  # stdev D
-                summ[1],  # sum C
-                num[1],  # n Times C
-                avg[1],  # Avg C
-                med[1],  # mean C
-                std[1],  # stdev C
-                summ[2],  # sum B
-                num[2],  # n Times B
-                avg[2],  # Avg B
-                med[2],  # mean B
-                std[2],  # stdev B
-                summ[3],  # sum A
-                num[3],  # n Times A
-                avg[3],  # Avg A
-                med[3],  # mean A
-                std[3],  # stdev A
-                finalRating,
-                seedValue,
-                runNr,
-                totalRuns,
+                for comp, asil, cal, dp, iso, risk, valW, valM, valL, cRating in records.tolist()
             ]
+            yield [[int(header["seedValue"]), int(header["runNr"]), int(header["totalRuns"])], rows]
+
+def append_row(rows, summ, num, avg, med, std, finalRating, seedValue=0, runNr=0, totalRuns=0):
+    """Buffer the results of a run in rows as a RESULTS_ROW_FORMAT line, to be written to the CSV file
+    with the other runs of the chunk. Takes the sum, number, average, median and standard deviation of
+    the ratings of each category and the final rating, as calculated by summarize_runs."""
+
+    # the ratings keep full precision until here, only the written values are rounded by the format
+    rows.append(
+        RESULTS_ROW_FORMAT
+        % (
+            summ[0],  # sum D
+            num[0],  # n Times D
+            avg[0],  # Avg D
+            med[0],  # mean D (median)
+            std[0],  # stdev D
+            summ[1],  # sum C
+            num[1],  # n Times C
+            avg[1],  # Avg C
+            med[1],  # mean C (median)
+            std[1],  # stdev C
+            summ[2],  # sum B
+            num[2],  # n Times B
+            avg[2],  # Avg B
+            med[2],  # mean B (median)
+            std[2],  # stdev B
+            summ[3],  # sum A
+            num[3],  # n Times A
+            avg[3],  # Avg A
+            med[3],  # mean A (median)
+            std[3],  # stdev A
+            finalRating,
+            seedValue,
+            runNr,
+            totalRuns,
         )
-
-        print(f"Data written to {FILENAME_RESULTS}")
+    )
+
+def cumulativeProbabilities(weights):
+    """Normalizes the weights and returns their cumulative probabilities, computed as rng.choice does"""
+
+    if min(weights) < 0 or sum(weights) <= 0:
+        raise ValueError("the weights must be non-negative and not all 0")
+    cdf = np.cumsum(np.asarray(weights) / sum(weights))
+    cdf /= cdf[-1]
+    return cdf
+
+@dataclass
+class Config:
+    """Parameters of a simulation, as given in the command line or asked to the user"""
+
+    type: str  # auto or manual
+    nr_runs: int
+    seedValue: int
+    numberECUs: int
+    vulnProb: float  # only used by the manual simulation, the auto one draws it for each run
+    maxVuln: float
+    minVuln: float
+    domainWeight: list  # weights of the components in the order of COMPONENT_TYPES
+    safetyWeight: list  # weights of the safety levels in the order of SAFETY_LEVELS
+
+def run_simulation(config, rng):
+    """Runs config.nr_runs simulations with the random data drawn from rng, appending the results to
+    FILENAME_RESULTS and the raw data to FILENAME_RAW. Does not ask for any input, so it can be called
+    for many configurations in the same process."""
+
+    # Convert the weights once into the cumulative probabilities used by all the runs
+    component_cdf = cumulativeProbabilities(config.domainWeight)
+    safety_cdf = cumulativeProbabilities(config.safetyWeight)
+
+    # Both files are opened once for all the runs
+    with open(FILENAME_RESULTS, mode="a", newline="", encoding="utf-8", buffering=FILE_BUFFERING) as file, open(
+        FILENAME_RAW, "ab", buffering=FILE_BUFFERING
+    ) as file_raw:
+        # in append mode the position is the size of the file, so it is new or empty when at 0
+        if file.tell() == 0:
+            file.write(",".join(RESULTS_HEADER) + RESULTS_LINE_END)  # Write the header row
+        rows = []
+
+        # The runs are simulated in chunks of up to RESULTS_BUFFER_ROWS runs and COMPONENTS_PER_CHUNK components
+        runsPerChunk = max(1, min(RESULTS_BUFFER_ROWS, COMPONENTS_PER_CHUNK // max(config.numberECUs, 1)))
+        for firstRun in range(0, config.nr_runs, runsPerChunk):
+            chunkRuns = min(runsPerChunk, config.nr_runs - firstRun)
+            if config.type == "auto":  # randomize for each run
+                vulnProbs = np.round(rng.uniform(0, 1, size=chunkRuns), 1)
+            else:
+                vulnProbs = [config.vulnProb] * chunkRuns
+
+            (runs, classRatings, sums, squaredDeviations, counts) = generate_simulation_data(
+                chunkRuns,
+                config.numberECUs,
+                vulnProbs,
+                config.maxVuln,
+                config.minVuln,
+                component_cdf,
+                safety_cdf,
+                rng,
+            )
+
+            # the statistics of all the runs of the chunk are calculated in a single call
+            avgs = np.empty((chunkRuns, 4))
+            medians = np.empty((chunkRuns, 4))
+            stds = np.empty((chunkRuns, 4))
+            finalRatings = np.empty(chunkRuns)
+            summarize_runs(sums, squaredDeviations, counts, classRatings, avgs, medians, stds, finalRatings)
+            summ, num, avg, med, std, final = (
+                values.tolist() for values in (sums, counts, avgs, medians, stds, finalRatings)
+            )
+
+            # write the raw data of the chunk to a file
+            write_to_file_raw(file_raw, runs, config.seedValue, firstRun + 1, config.nr_runs)
+
+            for nRun in range(chunkRuns):
+                runNr = firstRun + nRun + 1
+                append_row(
+                    rows,
+                    summ[nRun],
+                    num[nRun],
+                    avg[nRun],
+                    med[nRun],
+                    std[nRun],
+                    final[nRun],
+                    config.seedValue,
+                    runNr,
+                    config.nr_runs,
+                )
+
+            # write the buffered rows in a single call every RESULTS_BUFFER_ROWS runs
+            if len(rows) >= RESULTS_BUFFER_ROWS:
+                file.write("".join(rows))
+                rows.clear()
+
+        # write the rows still in the buffer
+        file.write("".join(rows))
+
+    logger.debug("Data written to %s", FILENAME_RESULTS)
 
 # TODO: get values from file to runit more times
 def main():
@@ -472,9 +753,12 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--type", help="the simulation type (auto or manual)", choices=["auto", "manual"])
     parser.add_argument("-n", "--runs", help="the number of times to run the simulation; greater than 0", type=int)
-    parser.add_argument("-s", "--seed", help="the seed value to be set (0 to randomize seed)", type=int)
+    parser.add_argument("-s", "--seed", help="the seed value to be set; non-negative (0 to randomize seed)", type=int)
+    parser.add_argument("-v", "--verbose", help="show the progress messages of the simulation", action="store_true")
     args = parser.parse_args()
 
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if args.verbose else logging.WARNING)
+
     type = args.type
     if not type:
         type = input("Choose the simulation type (auto or manual): ").strip()
@@ -482,32 +766,36 @@ def main():
     if seedValue is None:  # can be 0, which is false
         seedValue = int(input("Enter seed value to be set (0 to randomize seed):"))
 
+    if seedValue < 0:
+        parser.error(f"the seed value must be non-negative, got {seedValue}")
     if seedValue == 0:
         seedValue = random.randint(1, 10000)
     
+    # Generator used for all the random data of the runs
+    rng = np.random.Generator(np.random.PCG64DXSM(seedValue))
     if type == "auto":
         nr_runs = args.runs
         if not nr_runs:  # cannot be zero
             nr_runs = int(input("How many times would you like to repeat the simulation: "))
 
-        numberECUs = random.randint(0, 100)
-        vulnProb = vulbproba_security_feature(type)
-        maxVuln = round(random.uniform(0, 6.9), 1)
-        minVuln = round(random.uniform(0, maxVuln), 1)
+        numberECUs = int(rng.integers(0, 101))
+        vulnProb = vulbproba_security_feature(type, rng)
+        maxVuln = round(rng.uniform(0, 6.9), 1)
+        minVuln = round(rng.uniform(0, maxVuln), 1)
 
         domainWeight = [
-            round(random.uniform(0, 1), 1),  # Type ADAS
-            round(random.uniform(0, 1), 1),  # Type PowerTrain
-            round(random.uniform(0, 1), 1),  # Type HMI
-            round(random.uniform(0, 1), 1),  # Type Body
-            round(random.uniform(0, 1), 1),  # Type Chassi
+            round(rng.uniform(0, 1), 1),  # Type ADAS
+            round(rng.uniform(0, 1), 1),  # Type PowerTrain
+            round(rng.uniform(0, 1), 1),  # Type HMI
+            round(rng.uniform(0, 1), 1),  # Type Body
+            round(rng.uniform(0, 1), 1),  # Type Chassi
         ]
         safetyWeight = [
-        round(random.uniform(0, 1), 1),  # Type QM
-        round(random.uniform(0, 1), 1),  # Type A
-        round(random.uniform(0, 1), 1),  # Type B
-        round(random.uniform(0, 1), 1),  # Type C
-        round(random.uniform(0, 1), 1),  # Type D
+        round(rng.uniform(0, 1), 1),  # Type QM
+        round(rng.uniform(0, 1), 1),  # Type A
+        round(rng.uniform(0, 1), 1),  # Type B
+        round(rng.uniform(0, 1), 1),  # Type C
+        round(rng.uniform(0, 1), 1),  # Type D
         ]
     elif type == "manual":
         nr_runs = args.runs
@@ -515,7 +803,9 @@ def main():
             nr_runs = int(input("How many times would you like to repeat the simulation: "))
         
         numberECUs = int(input("How many ECU's do you wish to simulate (e.g values between 0 and 100): "))
-        vulnProb = vulbproba_security_feature(type)
+        if numberECUs < 0:
+            parser.error(f"the number of ECU's must be non-negative, got {numberECUs}")
+        vulnProb = vulbproba_security_feature(type, rng)
         maxVuln = float(input("Maximum vulnerability score (e.g values between 0 and 6.9): "))
         minVuln = float(input("Minimum vulnerability score (e.g values between 0 and 6.9, must be less than maximum): "))
         domainWeight = [
@@ -544,30 +834,11 @@ def main():
         ]
     else:
         print("Wrong Data")
-    
-    for nRun in range(nr_runs):
-        categoriesValues = [[], [], [], []]  # reset in every run
-        if type == "auto":  # randomize for each run
-            vulnProb = round(random.uniform(0, 1), 1)
-
-        (finalData, categoriesValues, finalRating) = generate_simulation_data(
-            numberECUs,
-            vulnProb,
-            categoriesValues,
-            maxVuln,
-            minVuln,
-            domainWeight[0],
-            domainWeight[1],
-            domainWeight[2],
-            domainWeight[3],
-            domainWeight[4],
-            safetyWeight[0],
-            safetyWeight[1],
-            safetyWeight[2],
-            safetyWeight[3],
-            safetyWeight[4],
-        )
-        write_to_file(finalData, categoriesValues, finalRating, seedValue, nRun + 1, nr_runs)
+
+        return
+
+    config = Config(type, nr_runs, seedValue, numberECUs, vulnProb, maxVuln, minVuln, domainWeight, safetyWeight)
+    run_simulation(config, rng)
 
 if __name__ == "__main__":
     # Declaration and track of all of the vehicle 5-grade rating values